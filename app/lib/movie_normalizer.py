@@ -1,53 +1,116 @@
+import collections
+import functools
+import json
 import subprocess
 import tempfile
 import shutil
 import os
 import sys
+import threading
+from itertools import chain
 from lib.logger import logger
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from pathlib import Path
 
 
 class MovieNormalizer:
-    def __init__(self):
-        pass
+    # Number of trailing stderr lines kept from subprocesses for error logging
+    STDERR_TAIL_LINES = 4096
+    # Channel layouts which are downmixed to stereo, all other audio tracks are left untouched
+    SUPPORTED_LAYOUTS = ("5.1", "7.1")
+    # Codecs which only get the short normalization tail after the downmix
+    DOLBY_CODECS = ("ac3", "eac3", "truehd")
+    # Codecs whose decoder applies dynamic range compression unless disabled with -drc_scale 0
+    DRC_CODECS = ("ac3", "eac3")
+    # RAM backed temp directory for normalized audio files (Linux only)
+    SHM_DIR = "/dev/shm"
+    # Bitrate of the normalized opus tracks in bit/s
+    OPUS_BITRATE = 224000
+    # Normalization filters applied after the downmix, see build_audio_filter for details
+    _FILTER_TAIL = "acompressor=threshold=-12dB:ratio=3:attack=5:release=250:makeup=1:mix=0.5," \
+        "dynaudnorm=f=125:g=13:p=0.85," \
+        "equalizer=f=2000:t=q:w=1:g=2," \
+        "highpass=f=20," \
+        "alimiter=limit=0.95"
+    _DOLBY_FILTER_TAIL = "dynaudnorm=f=125:g=13:p=0.85," \
+        "alimiter=limit=0.95"
+
+    def __init__(self, max_workers: Optional[int] = None):
+        # Number of threads used to process the audio filter graph, limited to the CPUs this process may run on
+        self.max_workers = max_workers or os.process_cpu_count()
+        # Input durations in seconds from get_audio_streams, used to size temporary files
+        self.durations = {}
 
     def get_audio_streams(self, file_path_input: str) -> List[Tuple]:
         """
-        Returns a list of tuples: (track_position, language, channel_layout)
+        Returns a list of tuples: (track_position, language, channel_layout, codec_name)
         track_position is 0-based audio track index for FFmpeg mapping
+        The duration of the input is read by the same probe and stored in self.durations
         """
-        logger.info(f"Probing audio streams for file: {file_path_input}")
+        logger.info("Probing audio streams for file: %s", file_path_input)
         cmd = [
             "ffprobe", "-v", "error", "-select_streams", "a",
-            "-show_entries", "stream=channel_layout:stream_tags=language",
-            "-of", "csv=p=0", file_path_input
+            "-show_entries", "stream=index,codec_name,channel_layout:stream_tags=language:format=duration",
+            "-of", "json", file_path_input
         ]
-        output = subprocess.check_output(cmd, text=True)
+        output = self._probe(cmd)
+        data = json.loads(output)
+        self.durations[file_path_input] = float(data.get("format", {}).get("duration") or 0.0)
         streams = []
-        for i, line in enumerate(output.strip().splitlines()):
-            parts = line.strip().split(',')
-            layout = parts[0] if len(parts) > 0 and parts[0] else "stereo"
-            lang = parts[1] if len(parts) > 1 and parts[1] else "und"
-            streams.append((i, lang, layout))
+        for i, stream in enumerate(data.get("streams", [])):
+            layout = stream.get("channel_layout") or "stereo"
+            lang = stream.get("tags", {}).get("language") or "und"
+            codec = stream.get("codec_name") or "unknown"
+            streams.append((i, lang, layout, codec))
         return streams
 
-    def build_pan_filter(self, layout):
+    def get_temp_dir(self, file_path_input: str, streams: List[Tuple]) -> str:
+        """
+        Returns the directory for temporary audio files.
+        Prefers the RAM backed /dev/shm if it has enough free space for all normalized tracks,
+        otherwise the default temp directory is used. Expects the input to be probed by get_audio_streams.
+        """
+        if not os.path.isdir(self.SHM_DIR):
+            return tempfile.gettempdir()
+        # Estimated size of the opus tracks plus headroom for VBR peaks and container overhead
+        size_estimate = self.durations.get(file_path_input, 0.0) * self.OPUS_BITRATE / 8 * len(streams) * 1.25
+        if not size_estimate:
+            logger.info("Unknown duration of %s, using default temp directory", file_path_input)
+            return tempfile.gettempdir()
+        stat = os.statvfs(self.SHM_DIR)
+        if size_estimate > stat.f_bavail * stat.f_frsize:
+            logger.info("Not enough space in %s for %.0f MiB, using default temp directory", self.SHM_DIR, size_estimate / 2**20)
+            return tempfile.gettempdir()
+        return self.SHM_DIR
+
+    @staticmethod
+    @functools.cache
+    def build_pan_filter(layout: str) -> str:
         """
         Returns a pan filter string based on the channel layout.
+        Results are cached per layout since movies usually share one layout across all audio tracks.
         """
-        logger.info(f"Set pan filter for layout: {layout}")
+        logger.debug("Set pan filter for layout: %s", layout)
+        if not layout.startswith(MovieNormalizer.SUPPORTED_LAYOUTS):
+            raise ValueError(f"Unsupported channel layout: {layout}")
         if layout.startswith("5.1"):
             pan_filter = "pan=stereo|FL=0.9*FL+1.0*FC+0.75*LFE+0.25*BL+0.25*SL|FR=0.9*FR+1.0*FC+0.75*LFE+0.25*BR+0.25*SR"
-        elif layout.startswith("7.1"):
-            pan_filter = "pan=stereo|FL=0.85*FL+1.0*FC+0.75*LFE+0.35*BL+0.35*SL|FR=0.85*FR+1.0*FC+0.75*LFE+0.35*BR+0.35*SR"
         else:
-            raise ValueError(f"Unsupported channel layout: {layout}")
-        logger.info(f"Pan filter: \"{pan_filter}\"")
+            pan_filter = "pan=stereo|FL=0.85*FL+1.0*FC+0.75*LFE+0.35*BL+0.35*SL|FR=0.85*FR+1.0*FC+0.75*LFE+0.35*BR+0.35*SR"
+        logger.debug("Pan filter: \"%s\"", pan_filter)
         return pan_filter
 
-    def build_audio_filter(self, layout: str) -> str:
+    @staticmethod
+    @functools.cache
+    def build_audio_filter(layout: str, codec: str) -> str:
         """
+        Returns the normalization filter chain for an audio track.
+
+        Every track is downmixed with the pan filter from build_pan_filter, which keeps the dialogue
+        weighting of centre and LFE. Dolby codecs (AC-3, E-AC-3, TrueHD) then only get the dynaudnorm
+        and alimiter stages described below, which keeps their filter graph short (on AC-3/E-AC-3 the
+        decoder's compression is disabled with -drc_scale 0). All other codecs get the full chain:
+
         1. acompressor (The "Squasher")
 
         threshold=-22dB:ratio=4:attack=5:release=250:makeup=4:mix=0.9
@@ -118,91 +181,118 @@ class MovieNormalizer:
 
             Limiter: "Don't let the volume go over the red line."
         """
-        pan_filter = self.build_pan_filter(layout)
-        filter_str = f"{pan_filter}," \
-            "acompressor=threshold=-12dB:ratio=3:attack=5:release=250:makeup=1:mix=0.5," \
-            "dynaudnorm=f=125:g=13:p=0.85," \
-            "equalizer=f=2000:t=q:w=1:g=2," \
-            "highpass=f=20," \
-            "alimiter=limit=0.95"
-        return filter_str
+        pan_filter = MovieNormalizer.build_pan_filter(layout)
+        if codec in MovieNormalizer.DOLBY_CODECS:
+            return f"{pan_filter},{MovieNormalizer._DOLBY_FILTER_TAIL}"
+        return f"{pan_filter},{MovieNormalizer._FILTER_TAIL}"
+
+    def _build_ffmpeg_cmd(self, file_path_input: str, streams: List[Tuple]) -> List[str]:
+        """
+        Returns the ffmpeg command up to the outputs: the input and a filter graph with one
+        chain per audio track, where the normalized track i is available as [a{i}].
+        """
+        cmd = ["ffmpeg", "-y"]
+        if any(codec in self.DRC_CODECS for _, _, _, codec in streams):
+            # Decode AC-3 without its dynamic range compression, dynaudnorm takes care of the dynamics
+            cmd.extend(["-drc_scale", "0"])
+        filter_complex = ";".join(
+            f"[0:a:{track_pos}]{self.build_audio_filter(layout, codec)}[a{track_pos}]"
+            for track_pos, _, layout, codec in streams
+        )
+        cmd.extend([
+            "-i", file_path_input,
+            "-filter_complex", filter_complex,
+            "-filter_complex_threads", str(self.max_workers),
+            "-hide_banner", "-nostats", "-loglevel", "error",
+        ])
+        return cmd
 
     def normalize_audio_streams(self, file_path_input: str, streams: List[Tuple]) -> str:
+        """
+        Writes every normalized track to a temporary .mka file for merge_streams_mkv.
+        These have to be regular files: mkvmerge seeks in its inputs to identify them and cannot read
+        from pipes or FIFOs. normalize_and_merge streams the encoded audio straight into the output instead.
+        """
+        # Demux the input once and run one filter chain per audio track inside a single filter graph
+        cmd = self._build_ffmpeg_cmd(file_path_input, streams)
+        temp_dir = self.get_temp_dir(file_path_input, streams)
         results = []
-        for stream in streams:
-            track_pos, lang, layout = stream
-            audio_filter = self.build_audio_filter(layout)
-            logger.info(f"FFMPEG: Create normalized stereo audio stream from track {track_pos}: {lang} {layout}")
-            audio_out = tempfile.NamedTemporaryFile(delete=False, suffix=".mka").name
-            cmd = [
-                "ffmpeg", "-y", "-i", file_path_input,
-                "-map", f"0:a:{track_pos}",
-                "-af", audio_filter,
-                "-c:a", "libopus", "-b:a", "224k", "-vbr", "on", "-ac", "2",
+        for track_pos, lang, layout, _ in streams:
+            logger.info("FFMPEG: Create normalized stereo audio stream from track %s: %s %s", track_pos, lang, layout)
+            audio_out = tempfile.NamedTemporaryFile(delete=False, suffix=".mka", dir=temp_dir).name
+            cmd.extend([
+                "-map", f"[a{track_pos}]",
+                "-c:a", "libopus", "-b:a", str(self.OPUS_BITRATE), "-vbr", "on", "-ac", "2", "-threads", "0",
                 "-f", "matroska",
-                "-hide_banner", "-nostats", "-loglevel", "error", "-progress", "pipe:1",
                 audio_out
-            ]
-            try:
-                logger.info(f"Running ffmpeg:\n```\n{' '.join(cmd)}\n```")
-                # Capture stderr so we can log the ffmpeg error output if it fails.
-                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
-            except subprocess.CalledProcessError as e:
-                if getattr(e, 'stderr', None):
-                    logger.error("ffmpeg stderr:\n\n%s", e.stderr)
-                logger.exception("ffmpeg raised CalledProcessError")
-                sys.exit(1)
-            except Exception as e:
-                if getattr(e, 'stderr', None):
-                    logger.error("ffmpeg stderr:\n\n%s", e.stderr)
-                logger.exception("Unexpected error during ffmpeg processing")
-                sys.exit(1)
-            logger.info(f"Created audio file: {audio_out} (lang={lang})")
+            ])
             results.append((audio_out, lang, layout))
+        try:
+            logger.info("Running ffmpeg:\n```\n%s\n```", " ".join(cmd))
+            self._run_process(cmd)
+        except subprocess.CalledProcessError as e:
+            if getattr(e, 'stderr', None):
+                logger.error("ffmpeg stderr:\n\n%s", e.stderr)
+            logger.exception("ffmpeg raised CalledProcessError")
+            # Batch mode keeps running after a failed movie, don't leave its temp files behind
+            self.delete_temp_files(results)
+            sys.exit(1)
+        except Exception as e:
+            if getattr(e, 'stderr', None):
+                logger.error("ffmpeg stderr:\n\n%s", e.stderr)
+            logger.exception("Unexpected error during ffmpeg processing")
+            self.delete_temp_files(results)
+            sys.exit(1)
+        for audio_out, lang, _ in results:
+            logger.info("Created audio file: %s (lang=%s)", audio_out, lang)
         return results
 
-    def merge_streams_ffmpeg(self, file_path_input: str, file_path_output: str, audio_streams: List[Tuple]) -> str:
-        # Start FFMPEG merge command with input file and set overwrite target
-        cmd = ["ffmpeg", "-y", "-i", file_path_input]
-        # Add new audio streams as additional inputs
-        for audio_file, _, _ in audio_streams:
-            cmd.extend(["-i", audio_file])
-        # Map video and subtitles
+    def normalize_and_merge(self, file_path_input: str, file_path_output: str, streams: List[Tuple],
+                            audio_track_count: Optional[int] = None) -> str:
+        # Normalize and mux in one ffmpeg call: the filter graph outputs go straight into the output container
+        # The new audio streams follow all original audio streams, not only the normalized ones
+        if audio_track_count is None:
+            audio_track_count = len(streams)
+        cmd = self._build_ffmpeg_cmd(file_path_input, streams)
+        # Map video, subtitles, audio and attachments
         # -map 0:v : Keep all video streams from original
         # -map 0:s? : Keep all subtitle streams from original if they exist
         # -map 0:a : Keep all original audio streams
-        cmd.extend(["-map", "0:v", "-map", "0:s?", "-map", "0:a"])
-        # Add old and new audio streams
-        for i in range(len(audio_streams)):
-            cmd.extend(["-map", f"{i+1}:a"])
-        # Copy everything by default
-        cmd.extend(["-c:v", "copy", "-c:s", "copy"])
-        # Re-encode new audio stream into mkv-compatible opus
-        cmd.extend(["-c:a", "libopus", "-b:a", "224k", "-vbr", "on"])
-        # Set new audio stream names (metadata)
-        for i, (_, lang, layout) in enumerate(audio_streams):
-            n = i+len(audio_streams)
-            filter_metadata = f"-metadata:s:a:{n}"
-            cmd.extend([
-                filter_metadata,
-                f"title={lang.upper()} stereo-max",
-                filter_metadata,
-                f"language={lang}",
+        # -map 0:t? : Keep attachments (e.g. fonts for ASS subtitles) if they exist
+        cmd.extend(["-map", "0:v", "-map", "0:s?", "-map", "0:a", "-map", "0:t?"])
+        # Add normalized audio streams from the filter graph
+        for track_pos, lang, layout, _ in streams:
+            logger.info("FFMPEG: Create normalized stereo audio stream from track %s: %s %s", track_pos, lang, layout)
+            cmd.extend(["-map", f"[a{track_pos}]"])
+        # Copy everything by default, including the original audio streams
+        cmd.extend(["-c", "copy", "-threads", "0"])
+        # Encode only the new audio streams into mkv-compatible opus and set their names (metadata)
+        bitrate = str(self.OPUS_BITRATE)
+        stream_options = [
+            [
+                f"-c:a:{n}", "libopus", f"-b:a:{n}", bitrate, f"-vbr:a:{n}", "on",
+                f"-metadata:s:a:{n}", f"title={lang.upper()} stereo-max",
+                f"-metadata:s:a:{n}", f"language={lang}",
                 f"-disposition:a:{n}", "0",  # Disable any default flag on new audio streams
-            ])
-        # Set log level
-        cmd.extend(["-hide_banner", "-nostats", "-loglevel", "error", "-progress", "pipe:1"])
+            ]
+            for n, (_, lang, _, _) in enumerate(streams, start=audio_track_count)
+        ]
+        cmd.extend(chain.from_iterable(stream_options))
+        # Always write Matroska like mkvmerge does, whatever the output extension
+        cmd.extend(["-f", "matroska"])
         # Set output file
         cmd.append(file_path_output)
-        logger.info(f"Merging new audio stream into file: {file_path_output}")
+        logger.info("Merging new audio stream into file: %s", file_path_output)
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            logger.info("Running ffmpeg:\n```\n%s\n```", " ".join(cmd))
+            self._run_process(cmd)
         except subprocess.CalledProcessError as e:
             logger.error("ffmpeg failed (returncode=%s cmd=%s)", e.returncode, e.cmd)
             if getattr(e, 'stderr', None):
                 logger.error("ffmpeg stderr:\n%s", e.stderr)
             logger.exception("ffmpeg raised CalledProcessError during merge")
-        logger.info(f"Result: {file_path_output}")
+            sys.exit(1)
+        logger.info("Result: %s", file_path_output)
         return file_path_output
 
     def merge_streams_mkv(self, file_path_input: str, file_path_output: str, audio_streams: List[Tuple]) -> str:
@@ -216,24 +306,65 @@ class MovieNormalizer:
                 "--default-track", f"0:no",
                 audio_file
             ])
-        logger.info(f"Merging new audio stream into file: {file_path_output}")
+        logger.info("Merging new audio stream into file: %s", file_path_output)
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            self._run_process(cmd)
         except subprocess.CalledProcessError as e:
-            logger.error("mkvmerge failed (returncode=%s cmd=%s)", e.returncode, e.cmd)
-            if getattr(e, 'stderr', None):
-                logger.error("mkvmerge stderr:\n%s", e.stderr)
-            logger.exception("mkvmerge raised CalledProcessError")
-        logger.info(f"Result: {file_path_output}")
+            # mkvmerge returns 1 for warnings, the output file is complete in that case
+            if e.returncode == 1:
+                logger.warning("mkvmerge finished with warnings (cmd=%s)", e.cmd)
+            else:
+                logger.error("mkvmerge failed (returncode=%s cmd=%s)", e.returncode, e.cmd)
+                if getattr(e, 'stderr', None):
+                    logger.error("mkvmerge stderr:\n%s", e.stderr)
+                logger.exception("mkvmerge raised CalledProcessError")
+                sys.exit(1)
+        logger.info("Result: %s", file_path_output)
         return file_path_output
 
     def delete_temp_files(self, audio_streams: List[Tuple]):
+        failed = []
         for audio_file, _, _ in audio_streams:
             try:
-                os.remove(audio_file)
-                logger.info(f"Deleted temporary audio file: {audio_file}")
+                Path(audio_file).unlink(missing_ok=True)
             except OSError as e:
-                logger.error(f"Error deleting temporary file {audio_file}: {e.strerror}")
+                failed.append(f"{audio_file} ({e.strerror})")
+        if failed:
+            logger.error("Deleted %d of %d temporary audio files, failed: %s",
+                         len(audio_streams) - len(failed), len(audio_streams), ", ".join(failed))
+        else:
+            logger.info("Deleted %d temporary audio files", len(audio_streams))
+
+    def _probe(self, cmd: List[str]) -> str:
+        """
+        Runs ffprobe and returns its stdout, logs ffprobe's stderr and exits if it fails
+        """
+        try:
+            proc = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            if getattr(e, 'stderr', None):
+                logger.error("ffprobe stderr:\n\n%s", e.stderr)
+            logger.exception("ffprobe raised CalledProcessError")
+            sys.exit(1)
+        return proc.stdout
+
+    def _run_process(self, cmd: List[str]):
+        """
+        Runs a command and raises CalledProcessError on a non-zero return code.
+        stderr is drained by a background thread into a bounded buffer, so a chatty process
+        can neither grow memory without limit nor stall on a full pipe. Only the last
+        STDERR_TAIL_LINES lines end up in CalledProcessError.stderr for logging.
+        """
+        tail = collections.deque(maxlen=self.STDERR_TAIL_LINES)
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=1 << 20, text=True,
+                                   errors="replace")
+        reader = threading.Thread(target=tail.extend, args=(process.stderr,), daemon=True)
+        reader.start()
+        returncode = process.wait()
+        reader.join()
+        process.stderr.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr="".join(tail))
 
     def _debug_copy_audio_files(self, audio_files: List[Tuple[str, str]], debug_dir: str):
         debug_path = Path(debug_dir)
@@ -241,4 +372,4 @@ class MovieNormalizer:
         for audio_file, lang in audio_files:
             dest_file = debug_path / f"normalized_{Path(audio_file).name}_lang_{lang}.opus"
             shutil.copy(audio_file, dest_file)
-            logger.info(f"Copied debug audio file to: {dest_file}")
+            logger.info("Copied debug audio file to: %s", dest_file)
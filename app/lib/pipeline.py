@@ -0,0 +1,62 @@
+import queue
+import threading
+from lib.logger import logger
+from typing import Callable, Iterable, List, Optional, Tuple
+
+# Marks the end of the job stream between two stages
+_DONE = object()
+
+
+def run_pipeline(jobs: Iterable[Tuple], stages: List[Callable[[Tuple], Optional[Tuple]]]) -> Tuple[List[Tuple], List[Tuple]]:
+    """
+    Runs jobs through a chain of stages, one worker thread per stage connected by queues.
+    While a job is in a later stage the next job is already processed by the earlier ones,
+    e.g. movie N is merged while movie N+1 is normalized and movie N+2 is probed.
+
+    A stage returns the job for the next stage or None to drop it.
+    A stage raising an exception (or calling sys.exit) only drops the current job.
+    Returns a tuple: (jobs which passed all stages, jobs which failed)
+    """
+    # Queues hold at most one waiting job so a fast stage cannot run far ahead (e.g. pile up temp files)
+    queues = [queue.Queue(maxsize=1) for _ in range(len(stages) + 1)]
+    failed = []
+    workers = [
+        threading.Thread(target=_stage_worker, args=(stage, queues[i], queues[i + 1], failed), daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+    for worker in workers:
+        worker.start()
+    results = []
+    # Collect in a separate thread so the feeding loop cannot block on a full last queue
+    collector = threading.Thread(target=_collect, args=(queues[-1], results), daemon=True)
+    collector.start()
+    for job in jobs:
+        queues[0].put(job)
+    queues[0].put(_DONE)
+    for worker in workers:
+        worker.join()
+    collector.join()
+    return results, failed
+
+
+def _stage_worker(stage: Callable[[Tuple], Optional[Tuple]], inbox: queue.Queue, outbox: queue.Queue, failed: List[Tuple]):
+    while (job := inbox.get()) is not _DONE:
+        try:
+            job = stage(job)
+        except SystemExit:
+            # Expected failures exit after logging their cause, no traceback needed
+            logger.error("Stage %s failed for job: %s", stage.__name__, job[0])
+            failed.append(job)
+            job = None
+        except BaseException:
+            logger.exception("Stage %s failed for job: %s", stage.__name__, job[0])
+            failed.append(job)
+            job = None
+        if job is not None:
+            outbox.put(job)
+    outbox.put(_DONE)
+
+
+def _collect(inbox: queue.Queue, results: List[Tuple]):
+    while (job := inbox.get()) is not _DONE:
+        results.append(job)
@@ -4,55 +4,146 @@ Usage: python app.py --input <input_file> --output <output_file>
 
 This script probes the input media file for audio streams, creates
 normalized stereo Opus renditions of each audio track, and merges them
-back into the output container (MKV by default). The CLI exposes two
-positional arguments: file_path_input and file_path_output. Use -h/--help
-for more information.
+back into an MKV output. Normalizing and merging happen in a single
+ffmpeg call; --mkvmerge switches to the two step variant which writes
+temporary audio files and muxes them with mkvmerge, keeping every track.
+The CLI exposes two positional arguments: file_path_input and
+file_path_output. If file_path_input is a directory or a glob pattern,
+all matching movies are processed in batch and file_path_output is used
+as output directory. Use -h/--help for more information.
 """
 
+import collections
+import glob
+import os
+import sys
 from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Tuple
 from lib.movie_normalizer import MovieNormalizer
+from lib.pipeline import run_pipeline
 from lib.logger import logger
 
+# File types picked up when a directory or glob pattern is given as input
+MOVIE_EXTENSIONS = {".mkv", ".mp4", ".m4v", ".mov", ".avi", ".webm", ".ts", ".m2ts"}
+
 
 def build_parser() -> ArgumentParser:
     parser = ArgumentParser(description="Normalize audio tracks in a movie and write results to a new file")
-    parser.add_argument("file_path_input", help="Path to the input media file (e.g. movie.mkv)")
-    parser.add_argument("file_path_output", help="Path for the output media file (will be overwritten if exists)")
+    parser.add_argument("file_path_input",
+                        help="Path to the input media file (e.g. movie.mkv), or a directory/glob pattern for batch mode")
+    parser.add_argument("file_path_output",
+                        help="Path for the output media file (will be overwritten if exists), or the output directory in batch mode")
+    parser.add_argument("-j", "--max-workers", type=int, default=None,
+                        help="Maximum number of threads used for audio filtering (default: number of CPUs usable by this process)")
+    parser.add_argument("--mkvmerge", action="store_true",
+                        help="Write normalized audio to temporary files and merge them with mkvmerge. "
+                             "Unlike the default ffmpeg route this keeps every track of the input, including data streams")
     return parser
 
 
+def collect_jobs(file_path_input: str, file_path_output: str) -> List[Tuple]:
+    """
+    Returns a list of tuples: (file_path_input, file_path_output, None)
+    A single input file maps to file_path_output, directories and glob patterns
+    map every movie to <file_path_output>/<name>_normalized.<ext>
+    """
+    # Existing files are never globs, movie names often contain brackets like "[1080p]"
+    if os.path.isfile(file_path_input):
+        return [(file_path_input, file_path_output, None)]
+    if os.path.isdir(file_path_input):
+        candidates = Path(file_path_input).iterdir()
+    elif any(c in file_path_input for c in "*?["):
+        candidates = map(Path, glob.glob(file_path_input))
+    else:
+        return [(file_path_input, file_path_output, None)]
+    # Skip previous results so re-running on the same directory does not normalize them again
+    inputs = sorted(
+        path for path in candidates
+        if path.is_file() and path.suffix.lower() in MOVIE_EXTENSIONS and not path.stem.endswith("_normalized")
+    )
+    if not inputs:
+        return []
+    output_dir = Path(file_path_output)
+    jobs = [
+        (str(path), str(output_dir / f"{path.stem}_normalized{path.suffix}"), None)
+        for path in inputs
+    ]
+    # A glob spanning directories can yield equal names, ffmpeg would silently overwrite one with the other
+    outputs = collections.Counter(output for _, output, _ in jobs)
+    duplicates = [output for output, count in outputs.items() if count > 1]
+    if duplicates:
+        logger.error("Several input files map to the same output file: %s", ", ".join(duplicates))
+        sys.exit(1)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return jobs
+
+
 def main():
     parser = build_parser()
     args = parser.parse_args()
 
-    normalizer = MovieNormalizer()
-
-    file_path_input = args.file_path_input
-    file_path_output = args.file_path_output
+    normalizer = MovieNormalizer(max_workers=args.max_workers)
 
-    logger.info(f"Starting normalization: input={file_path_input} output={file_path_output}")
-
-    # Probe audio streams
-    streams = normalizer.get_audio_streams(file_path_input)
-    if not streams:
-        logger.info("No audio streams found; nothing to do.")
+    jobs = collect_jobs(args.file_path_input, args.file_path_output)
+    if not jobs:
+        logger.info("No input files found; nothing to do.")
         return
 
-    # Create normalized temporary audio files
-    normalized_audio = normalizer.normalize_audio_streams(file_path_input, streams)
-
-    # Merge using mkvmerge if available, otherwise ffmpeg merge
-    try:
-        # Prefer mkvmerge method (keeps original streams intact)
-        result = normalizer.merge_streams_mkv(file_path_input, file_path_output, normalized_audio)
-    except Exception:
-        # Fall back to ffmpeg merging
-        result = normalizer.merge_streams_ffmpeg(file_path_input, file_path_output, normalized_audio)
-
-    # Cleanup temp files
-    normalizer.delete_temp_files(normalized_audio)
-
-    logger.info(f"Finished: {result}")
+    # Jobs dropped by probe because there is nothing to normalize
+    skipped = []
+
+    def probe(job):
+        file_path_input, file_path_output, _ = job
+        logger.info("Starting normalization: input=%s output=%s", file_path_input, file_path_output)
+        # Probe audio streams
+        streams = normalizer.get_audio_streams(file_path_input)
+        if not streams:
+            logger.info("No audio streams found in %s; nothing to do.", file_path_input)
+            skipped.append(job)
+            return None
+        audio_track_count = len(streams)
+        # Only multichannel tracks get a stereo rendition, skip ffmpeg entirely if there are none
+        streams = [stream for stream in streams if stream[2].startswith(normalizer.SUPPORTED_LAYOUTS)]
+        if not streams:
+            logger.info("No multichannel tracks to normalize in %s; nothing to do.", file_path_input)
+            skipped.append(job)
+            return None
+        return (file_path_input, file_path_output, streams, audio_track_count)
+
+    def normalize(job):
+        file_path_input, file_path_output, streams, _ = job
+        # Create normalized temporary audio files
+        return (file_path_input, file_path_output, normalizer.normalize_audio_streams(file_path_input, streams))
+
+    def merge(job):
+        file_path_input, file_path_output, normalized_audio = job
+        try:
+            # Merge using mkvmerge (keeps original streams intact)
+            result = normalizer.merge_streams_mkv(file_path_input, file_path_output, normalized_audio)
+        finally:
+            # Cleanup temp files
+            normalizer.delete_temp_files(normalized_audio)
+        logger.info("Finished: %s", result)
+        return job
+
+    def normalize_and_merge(job):
+        file_path_input, file_path_output, streams, audio_track_count = job
+        # Normalize and merge in a single ffmpeg pass without temporary files
+        result = normalizer.normalize_and_merge(file_path_input, file_path_output, streams, audio_track_count)
+        logger.info("Finished: %s", result)
+        return job
+
+    # Each stage runs in its own thread, so consecutive movies overlap in probing, encoding and muxing
+    stages = [probe, normalize, merge] if args.mkvmerge else [probe, normalize_and_merge]
+    finished, failed = run_pipeline(jobs, stages)
+
+    if len(jobs) > 1:
+        logger.info("Processed %d of %d files (%d skipped, %d failed)",
+                    len(finished), len(jobs), len(skipped), len(failed))
+    if failed:
+        logger.error("Failed files: %s", ", ".join(job[0] for job in failed))
+        sys.exit(1)
 
 
 if __name__ == "__main__":